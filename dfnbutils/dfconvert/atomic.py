@@ -0,0 +1,25 @@
+from contextlib import contextmanager
+import os
+import secrets
+
+
+@contextmanager
+def atomic_write(fname):
+    """Yields a text file next to fname that replaces fname once the block succeeds,
+    so readers never see a partially written file"""
+    dir_name, base_name = os.path.split(os.path.abspath(fname))
+    while True:
+        tmp_fname = os.path.join(dir_name, '.{}.{}.tmp'.format(base_name, secrets.token_hex(8)))
+        try:
+            # Created with the usual 0o666 so the kernel applies the process umask
+            fd = os.open(tmp_fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yield f
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.unlink(tmp_fname)
+        raise
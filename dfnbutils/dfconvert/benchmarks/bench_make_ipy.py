@@ -0,0 +1,235 @@
+"""Benchmarks for dfconvert.make_ipy on synthetic dataflow notebooks.
+
+Each scenario generates a notebook, then times export_dfpynb, transform_out_refs,
+transform_last_node, out_assign and topological separately and records their peak
+memory with tracemalloc. Results are compared against a stored baseline.
+
+Run from the dfnbutils directory:
+
+    python -m dfconvert.benchmarks.bench_make_ipy [--save-baseline] [--scenario NAME]
+
+Timings are only comparable on the machine that produced the baseline, regenerate
+it with --save-baseline when switching machines."""
+import argparse
+import base64
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import asttokens
+
+import dfconvert.make_ipy as ipy
+from dfconvert.constants import DEFAULT_ID_LENGTH
+from dfconvert.topological import topological
+
+BASELINE_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Every scenario varies a single parameter of the base notebook
+BASE_SCENARIO = {'cells': 200, 'fan_in': 2, 'fan_out': 4, 'tag_density': 0.5, 'tuple_ratio': 0.1, 'payload': 0}
+SCENARIOS = {
+    'base': {},
+    'cells-50': {'cells': 50},
+    'cells-800': {'cells': 800},
+    'fan-in-8': {'fan_in': 8},
+    'fan-out-32': {'fan_out': 32},
+    'tags-none': {'tag_density': 0.0},
+    'tags-all': {'tag_density': 1.0},
+    'tuples-all': {'tuple_ratio': 1.0},
+    'payload-64k': {'payload': 64 * 1024},
+    'payload-256k': {'payload': 256 * 1024},
+}
+# Timing differences below this are noise whatever their ratio
+MIN_DELTA_SECONDS = 0.002
+FUNCTIONS = ['export_dfpynb', 'transform_out_refs', 'transform_last_node', 'out_assign', 'topological']
+
+
+def make_notebook(cells=200, fan_in=2, fan_out=4, tag_density=0.5, tuple_ratio=0.1, payload=0, seed=0):
+    """Builds a dfkernel notebook along with the cell dependency graph it encodes.
+
+    Each cell refers to fan_in earlier cells, picked among every (fan_out // fan_in)th
+    cell so that a referenced cell is used by about fan_out others. Tagged cells are
+    referred to by name, untagged ones through Out["id"]. tuple_ratio of the tagged cells
+    end with a tuple of two names and payload bytes of image data are attached to
+    every cell's outputs."""
+    rng = random.Random(seed)
+    stride = max(1, fan_out // max(1, fan_in))
+    blob = base64.b64encode(rng.randbytes(payload)).decode('ascii') if payload else None
+    nb_cells, graph, names = [], {}, []
+    for idx in range(cells):
+        exec_count = 0x100000 + idx
+        cell_id = hex(exec_count)[2:].zfill(DEFAULT_ID_LENGTH)
+        hubs = list(range(0, idx, stride))
+        sources = rng.sample(hubs, min(fan_in, len(hubs)))
+        graph[cell_id] = [names[src][0] for src in sources]
+        expr = ' + '.join([names[src][1] for src in sources] + [str(idx)])
+
+        outputs = []
+        if rng.random() < tag_density:
+            if rng.random() < tuple_ratio:
+                tags = ['v{}'.format(idx), 'w{}'.format(idx)]
+                source = '{0}, {1} = {2}, {3}\n{0}, {1}'.format(tags[0], tags[1], expr, idx)
+            else:
+                tags = ['v{}'.format(idx)]
+                source = '{0} = {1}\n{0}'.format(tags[0], expr)
+            for tag in tags:
+                outputs.append({'data': {'text/plain': [str(idx)]}, 'execution_count': exec_count,
+                                'metadata': {'output_tag': tag}, 'output_type': 'execute_result'})
+            names.append((cell_id, tags[0]))
+        else:
+            source = expr
+            outputs.append({'data': {'text/plain': [str(idx)]}, 'execution_count': exec_count,
+                            'metadata': {}, 'output_type': 'execute_result'})
+            names.append((cell_id, 'Out["{}"]'.format(cell_id)))
+        if blob is not None:
+            outputs.append({'data': {'image/png': blob, 'text/plain': ['<Figure>']},
+                            'metadata': {}, 'output_type': 'display_data'})
+        nb_cells.append({'cell_type': 'code', 'execution_count': exec_count, 'metadata': {},
+                         'outputs': outputs, 'source': source})
+
+    nb = {'cells': nb_cells,
+          'metadata': {'kernelspec': {'display_name': 'DFPython 3', 'language': 'python', 'name': 'dfpython3'}},
+          'nbformat': 4, 'nbformat_minor': 2}
+    return nb, graph
+
+
+def _cell_inputs(nb):
+    """Returns (source, id, tags) for every code cell after the input splitter has run"""
+    transformer = ipy.input_transformer()
+    inputs = []
+    for cell in nb['cells']:
+        cell_id = hex(cell['execution_count'])[2:].zfill(DEFAULT_ID_LENGTH)
+        tags = [out['metadata']['output_tag'] for out in cell['outputs'] if 'output_tag' in out['metadata']]
+        inputs.append((transformer.transform_cell(cell['source']), cell_id, tags))
+    return inputs
+
+
+def _setups(nb, graph, out_fname):
+    """Returns a setup function per benchmarked function. Setup does the untimed work
+    and returns the timed call, so parsing is never counted against a transformation."""
+    inputs = _cell_inputs(nb)
+
+    def export_dfpynb():
+        return lambda: ipy.export_dfpynb(nb, out_fname=out_fname)
+
+    def transform_out_refs():
+        casts = [(csource, asttokens.ASTTokens(csource, parse=True)) for csource, _, _ in inputs]
+        return lambda: [ipy.transform_out_refs(csource, cast) for csource, cast in casts]
+
+    def transform_last_node():
+        casts = [(csource, asttokens.ASTTokens(csource, parse=True), cell_id) for csource, cell_id, _ in inputs]
+        return lambda: [ipy.transform_last_node(csource, cast, cell_id) for csource, cast, cell_id in casts]
+
+    def out_assign():
+        # out_assign edits the tree it is given, so every run needs fresh casts
+        casts = []
+        for csource, cell_id, tags in inputs:
+            cast = asttokens.ASTTokens(csource, parse=True)
+            csource = ipy.transform_last_node(ipy.transform_out_refs(csource, cast), cast, cell_id)
+            casts.append((csource, asttokens.ASTTokens(csource, parse=True), cell_id, tags))
+        return lambda: [ipy.out_assign(csource, cast, cell_id, tags) for csource, cast, cell_id, tags in casts]
+
+    def topological_():
+        return lambda: list(topological(graph))
+
+    return {'export_dfpynb': export_dfpynb, 'transform_out_refs': transform_out_refs,
+            'transform_last_node': transform_last_node, 'out_assign': out_assign,
+            'topological': topological_}
+
+
+def measure(setup, repeat=5):
+    """Returns the best wall time of repeat runs and the peak memory of one traced run"""
+    best = None
+    for _ in range(repeat):
+        func = setup()
+        # Like timeit, keep collections triggered by earlier garbage out of the timing
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    func = setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def run(scenarios, repeat=5):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_fname = os.path.join(tmp_dir, 'bench_ipy.ipynb')
+        for name in scenarios:
+            params = dict(BASE_SCENARIO, **SCENARIOS[name])
+            nb, graph = make_notebook(**params)
+            setups = _setups(nb, graph, out_fname)
+            results[name] = {func: measure(setups[func], repeat) for func in FUNCTIONS}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints every measurement next to its baseline and returns the regressions"""
+    regressions = []
+    row = '{:<14} {:<20} {:>11} {:>9} {:>12} {:>9}'
+    print(row.format('scenario', 'function', 'time (ms)', 'vs base', 'peak (KiB)', 'vs base'))
+    for name, funcs in results.items():
+        for func, result in funcs.items():
+            base = baseline.get(name, {}).get(func)
+            ratios = ['', '']
+            if base is not None:
+                for idx, key in enumerate(('seconds', 'peak_bytes')):
+                    if base[key]:
+                        ratio = result[key] / base[key]
+                        ratios[idx] = '{:.2f}x'.format(ratio)
+                        noise = MIN_DELTA_SECONDS if key == 'seconds' else 0
+                        if ratio > 1 + tolerance and result[key] - base[key] > noise:
+                            regressions.append((name, func, key, ratio))
+            print(row.format(name, func, '{:.2f}'.format(result['seconds'] * 1000), ratios[0],
+                             '{:.1f}'.format(result['peak_bytes'] / 1024), ratios[1]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="only run this scenario, may be given more than once")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per measurement, the best is kept")
+    parser.add_argument('--baseline', default=BASELINE_FNAME, help="baseline file to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help="allowed slowdown or memory growth before a result counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.scenario or list(SCENARIOS), args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print("Baseline written to {}".format(args.baseline))
+        return 0
+
+    for name, func, key, ratio in regressions:
+        print("REGRESSION {} {} {}: {:.2f}x baseline".format(name, func, key, ratio))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
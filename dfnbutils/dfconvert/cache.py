@@ -0,0 +1,96 @@
+import hashlib
+import json
+
+from dfconvert.atomic import atomic_write
+
+CACHE_VERSION = 2
+
+
+def cell_hash(source):
+    """Returns a stable digest of a cell's source, lists of lines are joined first"""
+    if not isinstance(source, str):
+        source = "".join(source)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class TransformCache:
+    """Per-cell cache of export_dfpynb transformation results.
+
+    Entries map a key built from the cell source hash, its id and its output tags to
+    the transformed source, out target sources and dependency list of the cell.
+    The cache lives in memory, if path is given it is loaded from and saved to disk.
+    Each export records the keys it used for its notebook, entries no notebook uses
+    any more are dropped, so edited cells do not pile up across re-exports and
+    notebooks sharing a cache keep each other's entries."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        # notebook -> keys its last export used
+        self.notebooks = {}
+        self.dirty = False
+        # Keys hit or put by the export in progress
+        self.used = set()
+        if path is not None:
+            self.load()
+
+    def load(self):
+        """Reads the cache file, a missing, unreadable or outdated file gives an empty cache"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            # Entries written by an older transformation are not trustworthy
+            if data.get('version') == CACHE_VERSION:
+                entries, notebooks = data.get('cells', {}), data.get('notebooks', {})
+                if isinstance(entries, dict) and isinstance(notebooks, dict):
+                    self.entries, self.notebooks = entries, notebooks
+        except (FileNotFoundError, ValueError, TypeError, AttributeError):
+            pass
+
+    @staticmethod
+    def key(source, exec_count, valid_tags, full_transform=False):
+        # The cell id is part of the key since it is baked into the Out_ names
+        key = json.dumps([cell_hash(source), exec_count, list(valid_tags), bool(full_transform)])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def start_export(self):
+        self.used = set()
+
+    def finish_export(self, notebook=''):
+        """Makes the keys used since start_export the entries kept for notebook
+        and drops every entry that no notebook uses any more"""
+        used = sorted(self.used)
+        if self.notebooks.get(notebook) != used:
+            self.notebooks[notebook] = used
+            self.dirty = True
+        live = {key for keys in self.notebooks.values() for key in keys}
+        for key in set(self.entries) - live:
+            del self.entries[key]
+            self.dirty = True
+        self.used = set()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.used.add(key)
+        return entry['source'], list(entry['out_targets']), list(entry['deps'])
+
+    def put(self, key, source, out_targets, deps):
+        self.entries[key] = {'source': source, 'out_targets': list(out_targets), 'deps': list(deps)}
+        self.used.add(key)
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        # Written through a temp file so an interrupted save never leaves a truncated cache
+        with atomic_write(self.path) as f:
+            json.dump({'version': CACHE_VERSION, 'cells': self.entries, 'notebooks': self.notebooks}, f)
+        self.dirty = False
@@ -1,2 +1,3 @@
 DEFAULT_ID_LENGTH = 6
 DF_CELL_PREFIX = "### This Cell has been converted to IPykernel from Dfkernel \n"
+MAX_CONCURRENT_EXPORTS = 2
@@ -0,0 +1,74 @@
+import json
+
+from dfconvert.atomic import atomic_write
+
+INDEX_VERSION = 1
+
+
+class DependencyIndex:
+    """Sidecar index of a converted notebook's cell dependency graph.
+
+    Cells are keyed by TransformCache.key, a hash of their source, id and output tags,
+    so dataflow order and per-cell dependencies can be queried without parsing any
+    cell, and the index no longer matches once any cell changes."""
+
+    def __init__(self, cells, order, full_transform=False):
+        # cell key -> {'id': cell id, 'deps': ids of the cells it depends on}
+        self.cells = cells
+        # cell keys in dataflow order
+        self.order = order
+        self.full_transform = full_transform
+        self.ids = {entry['id']: key for key, entry in cells.items()}
+
+    @classmethod
+    def from_graph(cls, cell_keys, deps, order, full_transform=False):
+        """Builds the index from (cell id, key) pairs, the resolved deps and the cell ids in dataflow order"""
+        keys = dict(cell_keys)
+        # Tags of the same cell resolve to the same id, keep each dependency once
+        cells = {key: {'id': cell_id, 'deps': sorted(set(deps.get(cell_id, [])))} for cell_id, key in keys.items()}
+        return cls(cells, [keys[cell_id] for cell_id in order if cell_id in keys], full_transform)
+
+    @classmethod
+    def load(cls, fname):
+        """Returns the index stored in fname, None if it is missing, unreadable or was written
+        by another version, so callers fall back to a full conversion"""
+        try:
+            with open(fname, 'r') as f:
+                data = json.load(f)
+            if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+                return None
+            return cls(data['cells'], data['order'], data.get('full_transform', False))
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, fname):
+        # Written through a temp file so a concurrent load never sees a truncated index
+        with atomic_write(fname) as f:
+            json.dump({'version': INDEX_VERSION, 'full_transform': self.full_transform,
+                       'cells': self.cells, 'order': self.order}, f, separators=(',', ':'))
+
+    def matches(self, cell_keys, full_transform=False):
+        """Checks that the index was built from exactly these (cell id, key) pairs"""
+        return full_transform == self.full_transform and dict(cell_keys) == self.ids
+
+    def dataflow_order(self):
+        """Cell ids in the order the converted notebook runs them"""
+        return [self.cells[key]['id'] for key in self.order]
+
+    def dependencies(self, cell_id, recursive=False):
+        """Ids of the cells cell_id reads from, with recursive all of its ancestors in dataflow order"""
+        direct = self.cells[self.ids[cell_id]]['deps']
+        if not recursive:
+            return list(direct)
+        seen = set()
+        stack = list(direct)
+        while stack:
+            dep = stack.pop()
+            if dep not in seen:
+                seen.add(dep)
+                stack.extend(self.cells[self.ids[dep]]['deps'])
+        return [dep for dep in self.dataflow_order() if dep in seen]
+
+    def dependents(self, cell_id):
+        """Ids of the cells that read from cell_id"""
+        return [entry['id'] for entry in self.cells.values() if cell_id in entry['deps']]
@@ -1,12 +1,18 @@
 from collections import defaultdict
-import json
+import asyncio
+import concurrent.futures
 import os
-from dfconvert.constants import DEFAULT_ID_LENGTH,DF_CELL_PREFIX
+from dfconvert.constants import DEFAULT_ID_LENGTH,DF_CELL_PREFIX,MAX_CONCURRENT_EXPORTS
 from dfconvert.topological import topological
+from dfconvert.streaming import open_notebook, write_notebook
+from dfconvert.atomic import atomic_write
+from dfconvert.cache import TransformCache
+from dfconvert.depindex import DependencyIndex
 import ast
 #Adds tokens to the ast
 import asttokens
-import IPython.core
+import IPython.core.inputsplitter
+import IPython.core.inputtransformer
 import re
 import astor
 import sys
@@ -21,6 +27,11 @@ cell_template = {
   }
 
 
+def new_code_cell(source):
+    # Every new cell needs its own metadata and outputs, a plain dict(cell_template) shares them
+    return dict(cell_template, metadata={}, outputs=[], source=source)
+
+
 transformers = []
 
 
@@ -92,49 +103,116 @@ def transform_out_refs(csource,cast):
     return csource
 
 
-def export_dfpynb(d, in_fname=None, out_fname=None, md_above=True,full_transform=False,out_mode=False):
-    last_code_id = None
-    non_code_map = defaultdict(list)
-    code_cells = {}
-    deps = defaultdict(list)
-    out_tags = defaultdict(list)
-    refs = {}
-
-
-    def grab_deps(cast,exec_count):
-        for node in ast.walk(cast.tree):
-            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
-                out_ref = re.search('(?<=Out_)([0-9A-Fa-f]{' + str(DEFAULT_ID_LENGTH) + '})', node.id)
-                if out_ref:
-                    deps[exec_count].append(out_ref.group(0))
-                else:
-                    deps[exec_count].append(node.id)
-            # Grab magic lines and perform our own parsing
-            elif isinstance(node, ast.Call) and isinstance(node.func,
-                                                           ast.Attribute) and node.func.attr == 'run_line_magic' and node.args:
-                args = node.args
-                if args[0].s == 'split_out':
-                    for subnode in ast.walk(ast.parse(args[1].s)):
-                        if isinstance(subnode, ast.Name):
-                            deps[exec_count].append(subnode.id)
-
+def grab_deps(cast):
+    cell_deps = []
+    for node in ast.walk(cast.tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            out_ref = re.search('(?<=Out_)([0-9A-Fa-f]{' + str(DEFAULT_ID_LENGTH) + '})', node.id)
+            if out_ref:
+                cell_deps.append(out_ref.group(0))
+            else:
+                cell_deps.append(node.id)
+        # Grab magic lines and perform our own parsing
+        elif isinstance(node, ast.Call) and isinstance(node.func,
+                                                       ast.Attribute) and node.func.attr == 'run_line_magic' and node.args:
+            args = node.args
+            if args[0].s == 'split_out':
+                for subnode in ast.walk(ast.parse(args[1].s)):
+                    if isinstance(subnode, ast.Name):
+                        cell_deps.append(subnode.id)
+    return cell_deps
+
+
+def input_transformer(full_transform=False):
+    cell_transformers = list(transformers)
     #FIXME: Give access to this somewhere
     #This converts comments and strings as well not just in code identifiers
-    if (full_transform):
+    if full_transform:
         def transform(line):
             # Changes Out[aaa] and Out["aaa"] to Out_aaa
-            return re.sub('Out\[[\"|\']?([0-9A-Fa-f]{' + str(DEFAULT_ID_LENGTH) + '})[\"|\']?\]', r'Out_\1', line)
+            return re.sub('Out\\[[\"|\']?([0-9A-Fa-f]{' + str(DEFAULT_ID_LENGTH) + '})[\"|\']?\\]', r'Out_\1', line)
+
+        cell_transformers.append(IPython.core.inputtransformer.StatelessInputTransformer(transform))
+
+    return IPython.core.inputsplitter.IPythonInputSplitter(physical_line_transforms=cell_transformers)
+
+
+def transform_cell(csource, exec_count, valid_tags, transformer, full_transform=False):
+    """Rewrites a single dfkernel cell, returns the new source, the sources of any
+    tuple out targets and the raw names the cell depends on"""
+    csource = transformer.transform_cell(csource)
+    cast = asttokens.ASTTokens(csource, parse=True)
+
+    if not full_transform:
+        csource = transform_out_refs(csource,cast)
+
+    csource = transform_last_node(csource,cast,exec_count)
+
+    #Grab depedencies from cell
+    cell_deps = grab_deps(cast)
+
+    cast = asttokens.ASTTokens(csource, parse=True)
+    #Finish up by assigning all final expressions if they still don't have a value
+    csource,out_targets = out_assign(csource,cast,exec_count,valid_tags)
+
+    out_sources = []
+    if isinstance(out_targets, ast.Tuple):
+        out_sources = [str(astor.to_source(j)).rstrip() for j in out_targets.elts]
+    return DF_CELL_PREFIX + csource.rstrip(), out_sources, cell_deps
+
 
-        out_transformer = IPython.core.inputtransformer.StatelessInputTransformer(transform)
-        transformers.append(out_transformer)
+_worker_transformers = {}
 
-    transformer = IPython.core.inputsplitter.IPythonInputSplitter(physical_line_transforms=transformers)
 
+def _transform_job(job):
+    #Runs in a pool process, the input splitter is built once per process
+    csource, exec_count, valid_tags, full_transform = job
+    if full_transform not in _worker_transformers:
+        _worker_transformers[full_transform] = input_transformer(full_transform)
+    return transform_cell(csource, exec_count, valid_tags, _worker_transformers[full_transform], full_transform)
+
+
+def code_cell_info(cell):
+    """Returns the id, joined source and output tags of a code cell"""
+    exec_count = hex(cell['execution_count'])[2:].zfill(DEFAULT_ID_LENGTH)
+    csource = cell['source']
+    if not isinstance(csource, str):
+        csource = "".join(csource)
+
+    #Create list of all out_tags
+    valid_tags = []
+    if ('outputs' in cell):
+        for output in cell['outputs']:
+            if ('metadata' in output and 'output_tag' in output['metadata']):
+                valid_tags.append(output['metadata']['output_tag'])
+    return exec_count, csource, valid_tags
+
+
+def export_dfpynb(d, in_fname=None, out_fname=None, md_above=True,full_transform=False,out_mode=False,cache=None,compact=False,workers=None,index_fname=None):
+    """Converts a dfkernel notebook to an ipykernel notebook ordered by its dataflow.
+
+    If a TransformCache is passed as cache, cells whose source and output tags are
+    unchanged since the last export reuse their previous transformation.
+    With compact the output notebook is written without indentation.
+    With workers > 1 the per-cell transformation runs on a pool of that many processes.
+    If index_fname is given the resolved dependency graph is saved there as a DependencyIndex."""
+    last_code_id = None
+    non_code_map = defaultdict(list)
+    code_cells = {}
+    deps = defaultdict(list)
+    out_tags = defaultdict(list)
+    refs = {}
+
+    # The input notebook is never modified, changed cells are shallow copies
+    # and everything else is shared with it
+    in_cells = d['cells']
     if md_above:
         # reverse the cells
-        d["cells"].reverse()
+        in_cells = in_cells[::-1]
 
-    for count, cell in enumerate(d['cells']):
+    # First pass only collects the cells, every code cell is transformed independently
+    jobs = []
+    for count, cell in enumerate(in_cells):
         if cell['cell_type'] != "code":
             # keep non-code cells above or below code cell
             non_code_map[last_code_id].append(cell)
@@ -142,72 +220,62 @@ def export_dfpynb(d, in_fname=None, out_fname=None, md_above=True,full_transform
             # This condition should never happen but incase it does
             # we want to ignore cells without any execution count
             if ('execution_count' in cell):
-                exec_count = hex(cell['execution_count'])[2:].zfill(DEFAULT_ID_LENGTH)
+                exec_count, csource, valid_tags = code_cell_info(cell)
 
+                cell = dict(cell)
                 if 'metadata' in cell:
-                    cell.metadata.dfkernel_old_id = cell['execution_count']
+                    cell['metadata'] = dict(cell['metadata'], dfkernel_old_id=cell['execution_count'])
                 last_code_id = exec_count
-                csource = cell['source']
-                if not isinstance(csource, str):
-                    csource = "".join(csource)
-                csource = transformer.transform_cell(csource)
-                cast = asttokens.ASTTokens(csource, parse=True)
-
-
-                if not full_transform:
-                    csource = transform_out_refs(csource,cast)
-
-
-                csource = transform_last_node(csource,cast,exec_count)
-
-                #Grab depedencies from cell
-                grab_deps(cast,exec_count)
-
-
-                #Create list of all out_tags
-                valid_tags = []
-                if ('outputs' in cell):
-                    for output in cell['outputs']:
-                        if ('metadata' in output and 'output_tag' in output['metadata']):
-                            valid_tags.append(output['metadata']['output_tag'])
-
-
-
-                cast = asttokens.ASTTokens(csource, parse=True)
-                #Finish up by assigning all final expressions if they still don't have a value
-                csource,out_targets = out_assign(csource,cast,exec_count,valid_tags)
-                cell['source'] = DF_CELL_PREFIX + csource.rstrip()
-
-
-                for out_tag in valid_tags:
-                    out_tags[exec_count].append(out_tag)
-                    refs[out_tag] = exec_count
-                code_cells[exec_count] = [cell]
-                if out_mode:
-                    tree = ast.parse(cell['source'])
-                    if out_targets:
-                        if isinstance(out_targets, ast.Tuple):
-                            for j in out_targets.elts:
-                                new_cell = dict(cell_template)
-                                new_cell['source'] = DF_CELL_PREFIX + str(astor.to_source(j)).rstrip()
-                                code_cells[exec_count].append(new_cell)
-                    if tree.body and isinstance(tree.body[-1], ast.Assign) and isinstance(tree.body[-1].targets, list):
-                        for count, i in enumerate(tree.body[-1].targets):
-                            if len(tree.body[-1].targets) == count+1 and isinstance(i,ast.Name) and len(code_cells[exec_count]) == 1:
-                                new_cell = dict(cell_template)
-                                new_cell['source'] = DF_CELL_PREFIX + str(i.id)
-                                code_cells[exec_count].append(new_cell)
-                            if isinstance(i, ast.Tuple):
-                                for j in i.elts:
-                                    if isinstance(j, ast.Name):
-                                        new_cell = dict(cell_template)
-                                        new_cell['source'] = DF_CELL_PREFIX + str(j.id)
-                                        code_cells[exec_count].append(new_cell)
-                if exec_count not in deps:
-                    deps[exec_count] = []
+
+                jobs.append((cell, exec_count, csource, valid_tags))
             else:
                 continue
 
+    results = [None] * len(jobs)
+    if cache is not None:
+        cache.start_export()
+        cache_keys = [cache.key(csource, exec_count, valid_tags, full_transform)
+                      for _, exec_count, csource, valid_tags in jobs]
+        results = [cache.get(key) for key in cache_keys]
+    misses = [idx for idx, result in enumerate(results) if result is None]
+    miss_jobs = [(jobs[idx][2], jobs[idx][1], jobs[idx][3], full_transform) for idx in misses]
+    if workers is not None and workers > 1 and len(miss_jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            transformed = list(pool.map(_transform_job, miss_jobs,
+                                        chunksize=max(1, len(miss_jobs) // (workers * 4))))
+    else:
+        transformer = input_transformer(full_transform)
+        transformed = [transform_cell(csource, exec_count, valid_tags, transformer, full_transform)
+                       for csource, exec_count, valid_tags, _ in miss_jobs]
+    for idx, result in zip(misses, transformed):
+        results[idx] = result
+        if cache is not None:
+            cache.put(cache_keys[idx], *result)
+
+    # Merge in notebook order so the graph does not depend on how cells were transformed
+    for (cell, exec_count, csource, valid_tags), (cell_source, out_sources, cell_deps) in zip(jobs, results):
+        cell['source'] = cell_source
+        deps[exec_count].extend(cell_deps)
+
+        for out_tag in valid_tags:
+            out_tags[exec_count].append(out_tag)
+            refs[out_tag] = exec_count
+        code_cells[exec_count] = [cell]
+        if out_mode:
+            tree = ast.parse(cell['source'])
+            for out_source in out_sources:
+                code_cells[exec_count].append(new_code_cell(DF_CELL_PREFIX + out_source))
+            if tree.body and isinstance(tree.body[-1], ast.Assign) and isinstance(tree.body[-1].targets, list):
+                for count, i in enumerate(tree.body[-1].targets):
+                    if len(tree.body[-1].targets) == count+1 and isinstance(i,ast.Name) and len(code_cells[exec_count]) == 1:
+                        code_cells[exec_count].append(new_code_cell(DF_CELL_PREFIX + str(i.id)))
+                    if isinstance(i, ast.Tuple):
+                        for j in i.elts:
+                            if isinstance(j, ast.Name):
+                                code_cells[exec_count].append(new_code_cell(DF_CELL_PREFIX + str(j.id)))
+        if exec_count not in deps:
+            deps[exec_count] = []
+
     cells = []
     cells.extend(non_code_map[None])
 
@@ -228,17 +296,25 @@ def export_dfpynb(d, in_fname=None, out_fname=None, md_above=True,full_transform
 
     topo_deps = list(topological(deps))
 
+    if index_fname is not None:
+        DependencyIndex.from_graph(notebook_cell_keys(d, full_transform), deps, topo_deps[::-1],
+                                   full_transform).save(index_fname)
+
     while topo_deps:
         cid = topo_deps.pop()
         cells.extend(non_code_map[cid])
         cells.extend(code_cells[cid])
 
-    d['cells'] = cells
-
     # change the kernelspec
     # FIXME what if this metadata doesn't exist?
-    d["metadata"]["kernelspec"]["display_name"] = "Python 3"
-    d["metadata"]["kernelspec"]["name"] = "python3"
+    kernelspec = dict(d["metadata"]["kernelspec"], display_name="Python 3", name="python3")
+    out_nb = dict(d, cells=cells, metadata=dict(d["metadata"], kernelspec=kernelspec))
+
+    if cache is not None:
+        # Entries are grouped per notebook so that only this notebook's stale ones are dropped
+        notebook = in_fname or out_fname
+        cache.finish_export(os.path.abspath(notebook) if notebook is not None else '')
+        cache.save()
 
     if out_fname is None:
         if in_fname is not None:
@@ -246,29 +322,66 @@ def export_dfpynb(d, in_fname=None, out_fname=None, md_above=True,full_transform
             base, ext = os.path.splitext(base_name)
             out_fname = os.path.join(dir_name, base + '_ipy' + ext)
 
+    indent = None if compact else 4
     if out_fname is None:
-        json.dump(d, sys.stdout, indent=4)
+        write_notebook(out_nb, sys.stdout, indent)
     else:
-        with open(out_fname, 'w') as f:
-            json.dump(d, f, indent=4)
+        write_notebook_atomic(out_nb, out_fname, indent)
 
     return out_fname
 
-def bundle(handler, model):
-    """Converts the existing IPython Notebook file into a Dataflow Kernel File"""
+def write_notebook_atomic(d, out_fname, indent=4):
+    """Writes the notebook through a temp file next to out_fname,
+    so readers never see a partially written notebook"""
+    with atomic_write(out_fname) as f:
+        write_notebook(d, f, indent)
+
+def notebook_cell_keys(d, full_transform=False):
+    """Returns (cell id, key) for every code cell, the keys used by TransformCache and DependencyIndex"""
+    cell_keys = []
+    for cell in d['cells']:
+        if cell['cell_type'] == "code" and 'execution_count' in cell:
+            exec_count, csource, valid_tags = code_cell_info(cell)
+            cell_keys.append((exec_count, TransformCache.key(csource, exec_count, valid_tags, full_transform)))
+    return cell_keys
+
+def load_index(d, index_fname, full_transform=False):
+    """Loads the DependencyIndex saved for this notebook, None when there is none or any cell changed since"""
+    index = DependencyIndex.load(index_fname)
+    if index is None or not index.matches(notebook_cell_keys(d, full_transform), full_transform):
+        return None
+    return index
+
+_export_executor = None
+
+async def bundle_async(handler, model):
+    """Converts on a thread pool so the server event loop is never blocked,
+    at most MAX_CONCURRENT_EXPORTS conversions run at once and the rest wait their turn"""
+    global _export_executor
+    if _export_executor is None:
+        _export_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_EXPORTS,
+                                                                 thread_name_prefix='dfconvert-export')
     notebook_filename = model['path']
     notebook_content = model['content']
-    handler.finish('File Exported As: {}'.format(export_dfpynb(notebook_content, notebook_filename)))
+    loop = asyncio.get_running_loop()
+    out_fname = await loop.run_in_executor(_export_executor, export_dfpynb, notebook_content, notebook_filename)
+    handler.finish('File Exported As: {}'.format(out_fname))
+
+def bundle(handler, model):
+    """Converts the existing IPython Notebook file into a Dataflow Kernel File.
+    Called by the server's bundler handler, which awaits the returned future"""
+    return asyncio.ensure_future(bundle_async(handler, model))
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) < 2:
-        print("Usage: python {} <dfnb filename> [out filename]".format(sys.argv[0]))
+    args = [arg for arg in sys.argv[1:] if arg != '--compact']
+    if len(args) < 1:
+        print("Usage: python {} [--compact] <dfnb filename> [out filename]".format(sys.argv[0]))
         sys.exit(1)
 
     out_fname = None
-    if len(sys.argv) > 2:
-        out_fname = sys.argv[2]
-    with open(sys.argv[1], "r") as f:
-        d = json.load(f)
-        export_dfpynb(d, sys.argv[1])
\ No newline at end of file
+    if len(args) > 1:
+        out_fname = args[1]
+    # Outputs are streamed from the input file instead of being loaded
+    with open_notebook(args[0]) as d:
+        export_dfpynb(d, args[0], out_fname, compact='--compact' in sys.argv)
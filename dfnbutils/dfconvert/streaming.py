@@ -0,0 +1,235 @@
+"""Streaming notebook reader and writer for dfconvert.
+
+The reader walks a memory mapped notebook file and only decodes what the
+converter looks at. Cell outputs stay in the file as raw byte ranges, only the
+output_tag of each output is extracted, and the writer copies those ranges
+straight into the converted notebook."""
+from contextlib import contextmanager
+import codecs
+import json
+import mmap
+import re
+
+CHUNK_SIZE = 1 << 20
+
+_WS = re.compile(rb'[ \t\n\r]*')
+_STRUCT = re.compile(rb'["\[\]{}]')
+_SCALAR = re.compile(rb'[^,\]}\s]+')
+
+
+class RawJSON:
+    """A JSON value left untouched in the source buffer"""
+    __slots__ = ['buf', 'start', 'end']
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def chunks(self, size=CHUNK_SIZE):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for pos in range(self.start, self.end, size):
+            yield decoder.decode(self.buf[pos:min(pos + size, self.end)])
+        yield decoder.decode(b'', final=True)
+
+    def __repr__(self):
+        return 'RawJSON({}, {})'.format(self.start, self.end)
+
+
+class RawOutputs(list):
+    """The outputs of a code cell, reduced to the output_tag metadata of each output.
+
+    Iterating gives one small dict per output so the converter can read tags as usual,
+    the complete outputs are written back from raw."""
+
+    def __init__(self, raw, outputs):
+        super().__init__(outputs)
+        self.raw = raw
+
+
+def _skip_ws(buf, pos):
+    return _WS.match(buf, pos).end()
+
+
+def _expect(buf, pos, char):
+    if buf[pos:pos + 1] != char:
+        raise ValueError("Expected {!r} at byte {}".format(char.decode(), pos))
+
+
+def _skip_string(buf, pos):
+    """Returns the end of the JSON string starting at pos, find is much faster than
+    a regex over long base64 payloads"""
+    end = pos
+    while True:
+        end = buf.find(b'"', end + 1)
+        if end < 0:
+            raise ValueError("Unterminated JSON string at byte {}".format(pos))
+        escapes = 0
+        while buf[end - escapes - 1] == 0x5c:
+            escapes += 1
+        if escapes % 2 == 0:
+            return end + 1
+
+
+def _skip_value(buf, pos):
+    """Returns the end of the JSON value starting at pos without decoding it"""
+    char = buf[pos:pos + 1]
+    if char == b'"':
+        return _skip_string(buf, pos)
+    if char not in (b'{', b'['):
+        match = _SCALAR.match(buf, pos)
+        if match is None:
+            raise ValueError("Expected a JSON value at byte {}".format(pos))
+        return match.end()
+    depth = 0
+    while True:
+        match = _STRUCT.search(buf, pos)
+        if match is None:
+            raise ValueError("Unterminated JSON value")
+        char = match.group()
+        if char == b'"':
+            pos = _skip_string(buf, match.start())
+            continue
+        depth += 1 if char in (b'{', b'[') else -1
+        pos = match.end()
+        if depth == 0:
+            return pos
+
+
+def _iter_members(buf, pos):
+    """Yields (key, start, end) for each member of the JSON object at pos"""
+    _expect(buf, pos, b'{')
+    pos = _skip_ws(buf, pos + 1)
+    if buf[pos:pos + 1] == b'}':
+        return
+    while True:
+        _expect(buf, pos, b'"')
+        key_end = _skip_string(buf, pos)
+        key = json.loads(buf[pos:key_end])
+        pos = _skip_ws(buf, key_end)
+        _expect(buf, pos, b':')
+        start = _skip_ws(buf, pos + 1)
+        end = _skip_value(buf, start)
+        yield key, start, end
+        pos = _skip_ws(buf, end)
+        if buf[pos:pos + 1] == b'}':
+            return
+        _expect(buf, pos, b',')
+        pos = _skip_ws(buf, pos + 1)
+
+
+def _iter_elements(buf, pos):
+    """Yields (start, end) for each element of the JSON array at pos"""
+    _expect(buf, pos, b'[')
+    pos = _skip_ws(buf, pos + 1)
+    if buf[pos:pos + 1] == b']':
+        return
+    while True:
+        end = _skip_value(buf, pos)
+        yield pos, end
+        pos = _skip_ws(buf, end)
+        if buf[pos:pos + 1] == b']':
+            return
+        _expect(buf, pos, b',')
+        pos = _skip_ws(buf, pos + 1)
+
+
+def _read_outputs(buf, start, end):
+    outputs = []
+    for out_start, _ in _iter_elements(buf, start):
+        output = {}
+        for key, val_start, val_end in _iter_members(buf, out_start):
+            if key == 'metadata':
+                metadata = json.loads(buf[val_start:val_end])
+                if 'output_tag' in metadata:
+                    output['metadata'] = {'output_tag': metadata['output_tag']}
+        outputs.append(output)
+    return RawOutputs(RawJSON(buf, start, end), outputs)
+
+
+def iter_cells(buf, pos):
+    """Parses the cells of the JSON array at pos one at a time"""
+    for cell_start, _ in _iter_elements(buf, pos):
+        cell = {}
+        for key, start, end in _iter_members(buf, cell_start):
+            if key == 'outputs':
+                cell[key] = _read_outputs(buf, start, end)
+            else:
+                cell[key] = json.loads(buf[start:end])
+        yield cell
+
+
+def read_notebook(buf):
+    """Reads a notebook from a bytes-like buffer, keeping the outputs of code cells raw"""
+    nb = {}
+    for key, start, end in _iter_members(buf, _skip_ws(buf, 0)):
+        if key == 'cells':
+            nb[key] = list(iter_cells(buf, start))
+        else:
+            nb[key] = json.loads(buf[start:end])
+    return nb
+
+
+@contextmanager
+def open_notebook(fname):
+    """Memory maps fname and yields it read with read_notebook.
+    The raw outputs are only valid until the context exits."""
+    with open(fname, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        yield read_notebook(buf)
+
+
+def _encode(obj, indent, separators, level):
+    if isinstance(obj, RawOutputs):
+        obj = obj.raw
+    if isinstance(obj, RawJSON):
+        return obj.chunks()
+    text = json.dumps(obj, indent=indent, separators=separators)
+    if indent is not None:
+        # JSON strings never contain a raw newline, so this only shifts the layout
+        text = text.replace('\n', '\n' + ' ' * (indent * level))
+    return (text,)
+
+
+def _iter_container(items, indent, separators, level, open_char, close_char):
+    item_sep, key_sep = separators
+    if indent is not None:
+        newline = '\n' + ' ' * (indent * (level + 1))
+        item_sep = item_sep + newline
+    if not items:
+        yield open_char + close_char
+        return
+    yield open_char + (newline if indent is not None else '')
+    for idx, (key, chunks) in enumerate(items):
+        if idx:
+            yield item_sep
+        if key is not None:
+            yield json.dumps(key) + key_sep
+        yield from chunks
+    yield ('\n' + ' ' * (indent * level) if indent is not None else '') + close_char
+
+
+def iter_notebook(nb, indent=4):
+    """Encodes nb the same way json.dump does, copying raw outputs through unchanged.
+    With indent=None the notebook is written compactly, raw outputs keep their original layout."""
+    separators = (',', ': ') if indent is not None else (',', ':')
+
+    def encode_cell(cell):
+        return _iter_container([(key, _encode(val, indent, separators, 3)) for key, val in cell.items()],
+                               indent, separators, 2, '{', '}')
+
+    def encode_member(key, val):
+        if key == 'cells' and isinstance(val, list):
+            return _iter_container([(None, encode_cell(cell)) for cell in val],
+                                   indent, separators, 1, '[', ']')
+        return _encode(val, indent, separators, 1)
+
+    return _iter_container([(key, encode_member(key, val)) for key, val in nb.items()],
+                           indent, separators, 0, '{', '}')
+
+
+def write_notebook(nb, fp, indent=4):
+    for chunk in iter_notebook(nb, indent):
+        fp.write(chunk)
@@ -82,4 +82,198 @@ def test_mapping_results():
             for num,cell in enumerate(nb['cells']):
                 if 'outputs' in cell and len(cell['outputs']):
                     ans.append(cell['outputs'][0]['data']['text/plain'])
-            assert len([val for val in ans if val in answers]) == len(answers)
\ No newline at end of file
+            assert len([val for val in ans if val in answers]) == len(answers)
+
+def test_transform_cache(tmp_path):
+    """Re-exporting with a warm cache should give identical output and only re-transform edited cells"""
+    from dfconvert.cache import TransformCache
+    fname = os.path.join('./dfconvert/tests/example/', 'topology-test.ipynb')
+    cache_fname = str(tmp_path / 'cache.json')
+    out_fname = str(tmp_path / 'topology-test_ipy.ipynb')
+    cache = TransformCache(cache_fname)
+    ipy.export_dfpynb(nbformat.read(fname, nbformat.NO_CONVERT), out_fname=out_fname, cache=cache)
+    with open(out_fname) as f:
+        cold = f.read()
+    entries = len(cache)
+    assert entries > 0
+
+    cache = TransformCache(cache_fname)
+    assert len(cache) == entries
+    cache.put = None  # Any cache miss would now fail the export
+    ipy.export_dfpynb(nbformat.read(fname, nbformat.NO_CONVERT), out_fname=out_fname, cache=cache)
+    with open(out_fname) as f:
+        assert f.read() == cold
+
+    def cell_key(cell):
+        exec_count, csource, valid_tags = ipy.code_cell_info(cell)
+        return TransformCache.key(csource, exec_count, valid_tags)
+
+    # Edit one cell again and again through a single long-lived cache: only that cell's
+    # key misses each time and the replaced entry is dropped
+    nb = nbformat.read(fname, nbformat.NO_CONVERT)
+    idx = next(idx for idx, cell in enumerate(nb['cells']) if cell['cell_type'] == 'code')
+    cache = TransformCache(cache_fname)
+    put = cache.put
+    misses = []
+    cache.put = lambda key, *result: (misses.append(key), put(key, *result))
+    for edit in range(5):
+        old_key = cell_key(nb['cells'][idx])
+        nb['cells'][idx]['source'] += '\n# edit {}'.format(edit)
+        new_key = cell_key(nb['cells'][idx])
+        del misses[:]
+        ipy.export_dfpynb(nb, out_fname=out_fname, cache=cache)
+        assert misses == [new_key]
+        assert len(cache) == entries
+        assert new_key in cache and old_key not in cache
+
+    saved = TransformCache(cache_fname)
+    assert len(saved) == entries and new_key in saved
+
+    # Another notebook sharing the cache file must not evict this notebook's entries
+    other = os.path.join('./dfconvert/tests/example/', 'named_vars.ipynb')
+    ipy.export_dfpynb(nbformat.read(other, nbformat.NO_CONVERT), out_fname=str(tmp_path / 'named_vars_ipy.ipynb'), cache=saved)
+    shared = TransformCache(cache_fname)
+    assert new_key in shared and len(shared) > entries
+    shared.put = None
+    ipy.export_dfpynb(nb, out_fname=out_fname, cache=shared)
+
+    # A truncated cache file falls back to a cold export and is rewritten whole
+    with open(cache_fname) as f:
+        content = f.read()
+    with open(cache_fname, 'w') as f:
+        f.write(content[:len(content) // 2])
+    cache = TransformCache(cache_fname)
+    assert len(cache) == 0
+    ipy.export_dfpynb(nbformat.read(fname, nbformat.NO_CONVERT), out_fname=out_fname, cache=cache)
+    with open(out_fname) as f:
+        assert f.read() == cold
+    assert len(TransformCache(cache_fname)) == entries
+
+def test_streaming_export(tmp_path):
+    """Exporting from the streaming reader should match exporting the fully loaded notebook"""
+    from dfconvert.streaming import open_notebook
+    fname = os.path.join('./dfconvert/tests/example/', 'digits-classification-df.ipynb')
+    with open_notebook(fname) as nb:
+        streamed = ipy.export_dfpynb(nb, out_fname=str(tmp_path / 'streamed.ipynb'), out_mode=True, compact=True)
+    loaded = ipy.export_dfpynb(nbformat.read(fname, nbformat.NO_CONVERT), out_fname=str(tmp_path / 'loaded.ipynb'), out_mode=True)
+    with open(streamed) as f1, open(loaded) as f2:
+        assert f1.read(11) == '{"cells":[{'
+        f1.seek(0)
+        assert nbformat.read(f1, nbformat.NO_CONVERT) == nbformat.read(f2, nbformat.NO_CONVERT)
+
+def test_parallel_export(tmp_path):
+    """Transforming cells on a process pool should give the same notebook as the serial export"""
+    fname = os.path.join('./dfconvert/tests/example/', 'digits-classification-df.ipynb')
+    serial = ipy.export_dfpynb(nbformat.read(fname, nbformat.NO_CONVERT), out_fname=str(tmp_path / 'serial.ipynb'), out_mode=True)
+    parallel = ipy.export_dfpynb(nbformat.read(fname, nbformat.NO_CONVERT), out_fname=str(tmp_path / 'parallel.ipynb'), out_mode=True, workers=2)
+    with open(serial) as f1, open(parallel) as f2:
+        assert f1.read() == f2.read()
+
+def test_bundle(tmp_path):
+    """The bundler entry point should hand back a future, export next to the notebook and finish the handler"""
+    import asyncio
+
+    class Handler:
+        message = None
+
+        def finish(self, message):
+            self.message = message
+
+    fname = os.path.join('./dfconvert/tests/example/', 'topology-test.ipynb')
+    handler = Handler()
+    model = {'path': str(tmp_path / 'topology-test.ipynb'), 'content': nbformat.read(fname, nbformat.NO_CONVERT)}
+
+    async def serve():
+        # Like the server's handler: bundle() must return without running the export
+        future = ipy.bundle(handler, model)
+        assert asyncio.isfuture(future)
+        assert handler.message is None
+        await future
+
+    asyncio.run(serve())
+    out_fname = str(tmp_path / 'topology-test_ipy.ipynb')
+    assert handler.message == 'File Exported As: {}'.format(out_fname)
+    nbformat.validate(nbformat.read(out_fname, nbformat.NO_CONVERT))
+    assert os.listdir(str(tmp_path)) == ['topology-test_ipy.ipynb']
+
+def test_input_not_mutated(tmp_path):
+    """Converting must leave the caller's notebook untouched and give every new cell its own containers"""
+    import copy
+    import json
+    fname = os.path.join('./dfconvert/tests/example/', 'named_vars.ipynb')
+    nb = nbformat.read(fname, nbformat.NO_CONVERT)
+    original = copy.deepcopy(nb)
+    out_fname = ipy.export_dfpynb(nb, out_fname=str(tmp_path / 'named_vars_ipy.ipynb'), out_mode=True)
+    assert nb == original
+    with open(out_fname) as f:
+        assert json.load(f)['metadata']['kernelspec']['name'] == 'python3'
+
+    new_cells = [ipy.new_code_cell('a'), ipy.new_code_cell('b')]
+    assert new_cells[0]['outputs'] is not new_cells[1]['outputs']
+    assert new_cells[0]['metadata'] is not ipy.cell_template['metadata']
+
+def test_benchmark_notebook(tmp_path):
+    """Synthetic benchmark notebooks must stay convertible"""
+    from dfconvert.benchmarks.bench_make_ipy import make_notebook
+    nb, graph = make_notebook(cells=30, fan_in=3, tuple_ratio=0.5, payload=16)
+    out_fname = ipy.export_dfpynb(nb, out_fname=str(tmp_path / 'bench_ipy.ipynb'))
+    nbformat.validate(nbformat.read(out_fname, nbformat.NO_CONVERT))
+    assert len(graph) == 30
+
+def test_dependency_index(tmp_path):
+    """The sidecar index should answer graph queries and stop matching once a cell changes"""
+    from dfconvert.benchmarks.bench_make_ipy import make_notebook
+    nb, graph = make_notebook(cells=30, fan_in=2, tag_density=1.0)
+    index_fname = str(tmp_path / 'bench.deps.json')
+    out_fname = ipy.export_dfpynb(nb, out_fname=str(tmp_path / 'bench_ipy.ipynb'), index_fname=index_fname)
+
+    index = ipy.load_index(nb, index_fname)
+    assert index is not None
+    for cell_id, cell_deps in graph.items():
+        assert sorted(index.dependencies(cell_id)) == sorted(cell_deps)
+    order = index.dataflow_order()
+    for cell_id, cell_deps in graph.items():
+        assert all(order.index(dep) < order.index(cell_id) for dep in index.dependencies(cell_id, recursive=True))
+    new_nb = nbformat.read(out_fname, nbformat.NO_CONVERT)
+    assert [hex(cell['metadata']['dfkernel_old_id'])[2:] for cell in new_nb['cells']] == order
+
+    nb['cells'][3] = dict(nb['cells'][3], source=nb['cells'][3]['source'] + '\n')
+    assert ipy.load_index(nb, index_fname) is None
+
+    # Reading two tags of one tuple cell is a single dependency
+    tuple_nb, _ = make_notebook(cells=2)
+    tuple_nb['cells'][0] = dict(tuple_nb['cells'][0], source='v, w = 1, 2\nv, w', outputs=[
+        {'metadata': {'output_tag': tag}, 'output_type': 'execute_result', 'execution_count': 0x100000,
+         'data': {'text/plain': ['1']}} for tag in ('v', 'w')])
+    tuple_nb['cells'][1] = dict(tuple_nb['cells'][1], source='v + w', outputs=[])
+    ipy.export_dfpynb(tuple_nb, out_fname=str(tmp_path / 'tuple_ipy.ipynb'), index_fname=index_fname)
+    assert ipy.load_index(tuple_nb, index_fname).dependencies('100001') == ['100000']
+
+    # A truncated or missing index means a full conversion, not an error
+    with open(index_fname) as f:
+        content = f.read()
+    with open(index_fname, 'w') as f:
+        f.write(content[:len(content) // 2])
+    assert ipy.load_index(tuple_nb, index_fname) is None
+    assert ipy.load_index(tuple_nb, str(tmp_path / 'missing.json')) is None
+
+def test_atomic_write_permissions(tmp_path):
+    """Atomically written files should get the permissions the umask allows, and no temp file may be left"""
+    from dfconvert.atomic import atomic_write
+    umask = os.umask(0o022)
+    try:
+        fname = str(tmp_path / 'out.json')
+        with atomic_write(fname) as f:
+            f.write('{}')
+        assert os.stat(fname).st_mode & 0o777 == 0o644
+        try:
+            with atomic_write(fname) as f:
+                f.write('partial')
+                raise RuntimeError
+        except RuntimeError:
+            pass
+    finally:
+        os.umask(umask)
+    with open(fname) as f:
+        assert f.read() == '{}'
+    assert os.listdir(str(tmp_path)) == ['out.json']